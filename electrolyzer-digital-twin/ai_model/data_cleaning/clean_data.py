@@ -1,72 +1,112 @@
 import pandas as pd
 import numpy as np
+import matplotlib
+matplotlib.use('Agg')  # headless: الرسم يُحفظ في ملف فقط
 import matplotlib.pyplot as plt
 import seaborn as sns
 from sklearn.ensemble import IsolationForest
 from sklearn.preprocessing import LabelEncoder
-import pickle  # لحفظ model
+from joblib import dump  # لحفظ model (مضغوط، أصغر وأسرع من pickle لمصفوفات NumPy)
 import os
 import logging
 
+# pyarrow (إن وجد) يقرأ CSV بشكل متعدد الخيوط ويكتب Parquet، وإلا نرجع لـ C engine و CSV
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+CSV_ENGINE = 'pyarrow' if HAS_PYARROW else 'c'
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # مسار الملف الأصلي (عدل حسب الحاجة)
 file_path = 'ACWA Power 2 (1).csv'  # أو r'full\path\to\csv'
-output_path = 'cleaned_acwa_power_data.csv'
-model_path = 'isolation_forest_model.pkl'
+output_path = 'cleaned_acwa_power_data.parquet' if HAS_PYARROW else 'cleaned_acwa_power_data.csv'
+model_path = 'isolation_forest_model.joblib'
+features_path = 'features.npy'  # cache لمصفوفة features بعد التنظيف
+features_cols_path = 'features_cols.txt'  # أسماء أعمدة features.npy بالترتيب، سطر لكل عمود
 
 # أعمدة افتراضية لـ Electrolyzer (يمكن تعديل)
 relevant_cols = ['temperature', 'pressure', 'voltage', 'current', 'flow_rate']
 
 try:
-    # قراءة CSV مع UTF-8 للدعم العربي
-    df = pd.read_csv(file_path, encoding='utf-8')
-    logger.info("=== شكل البيانات الأصلية ===")
-    logger.info(df.shape)
-    logger.info("\nأول 5 صفوف:")
-    logger.info(df.head())
-
-    # تنظيف أساسي: إزالة القيم المفقودة
-    df_clean = df.dropna()
-    
-    # اختيار الأعمدة المتاحة فقط
-    available_cols = [col for col in relevant_cols if col in df_clean.columns]
+    # اختيار الأعمدة المتاحة فقط (قراءة الـ header فقط)
+    header = pd.read_csv(file_path, encoding='utf-8', nrows=0).columns
+    available_cols = [col for col in relevant_cols if col in header]
     if not available_cols:
         raise ValueError("لا توجد أعمدة حساسات متاحة!")
     logger.info(f"الأعمدة المستخدمة: {available_cols}")
-    df_clean = df_clean[available_cols]
+
+    # features المخزنة صالحة إذا كانت أحدث من CSV وبنفس الأعمدة وبنفس الترتيب: mmap بدل قراءة CSV من جديد
+    features = None
+    if (os.path.exists(features_path) and os.path.exists(features_cols_path)
+            and os.path.getmtime(features_path) >= os.path.getmtime(file_path)):
+        with open(features_cols_path, encoding='utf-8') as f:
+            cached_cols = f.read().splitlines()
+        cached = np.load(features_path, mmap_mode='r')
+        if cached_cols == available_cols and cached.ndim == 2 and cached.shape[1] == len(available_cols):
+            features = cached
+            df_clean = pd.DataFrame(features, columns=available_cols)
+            logger.info(f"استخدام features المخزنة في {features_path} ({len(df_clean)} صف)")
+
+    if features is None:
+        # قراءة أعمدة الحساسات فقط كـ float32 مع UTF-8 للدعم العربي
+        df = pd.read_csv(file_path, encoding='utf-8', engine=CSV_ENGINE,
+                         usecols=available_cols,
+                         dtype={col: 'float32' for col in available_cols})
+        logger.info("=== شكل البيانات الأصلية ===")
+        logger.info(df.shape)
+        logger.info("\nأول 5 صفوف:")
+        logger.info(df.head())
+
+        # تنظيف أساسي: إزالة القيم المفقودة في أعمدة الحساسات فقط
+        df_clean = df[available_cols].dropna(how='any')
+        # float32 هو نوع البيانات الداخلي للأشجار، فلا نسخ إضافي في fit/predict
+        features = np.ascontiguousarray(df_clean.to_numpy(dtype=np.float32))
+        np.save(features_path, features)
+        with open(features_cols_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(available_cols))
+        logger.info(f"تم حفظ features في {features_path}")
     
     # إضافة label باستخدام Isolation Forest (أفضل من IQR)
     if len(df_clean) > 0:
-        model = IsolationForest(contamination=0.1, random_state=42)  # 10% anomalies
-        features = df_clean[available_cols].values
-        predictions = model.predict(features)
-        df_clean['label'] = ['anomaly' if pred == -1 else 'normal' for pred in predictions]
+        # 10% anomalies، n_jobs=-1 يبني الأشجار على كل الأنوية
+        # max_features=1.0 = كل الأعمدة لكل شجرة (القيمة الافتراضية، صريحة هنا)
+        model = IsolationForest(n_estimators=100, max_samples=256, max_features=1.0,
+                                contamination=0.1, random_state=42, n_jobs=-1)
+        predictions = model.fit_predict(features)
+        # vectorized labeling، و Categorical يخزن codes بدل Python strings
+        df_clean['label'] = pd.Categorical(np.where(predictions == -1, 'anomaly', 'normal'))
         
         # حفظ الـ model للـ Backend
-        with open(model_path, 'wb') as f:
-            pickle.dump(model, f)
+        dump(model, model_path, compress=3)
         logger.info(f"تم حفظ AI Model في {model_path}")
     else:
         df_clean['label'] = 'normal'  # fallback
         logger.warning("لا بيانات كافية لتدريب model.")
 
-    # حفظ الملف المُنظف
-    df_clean.to_csv(output_path, index=False, encoding='utf-8')
+    # حفظ الملف المُنظف (Parquet عمودي مضغوط أسرع بكثير من CSV)
+    if HAS_PYARROW:
+        df_clean.to_parquet(output_path, engine='pyarrow', compression='zstd', index=False)
+    else:
+        df_clean.to_csv(output_path, index=False, encoding='utf-8')
     logger.info(f"\n=== تم حفظ البيانات المُنظفة في {output_path} ===")
     logger.info("\nإحصائيات وصفية:")
     logger.info(df_clean.describe())
     logger.info(f"توزيع Labels: {df_clean['label'].value_counts()}")
 
     # رسم بياني (heatmap للارتباطات)
-    if len(available_cols) > 1:
+    if len(available_cols) > 1 and len(df_clean) > 0:
         plt.figure(figsize=(10, 6))
-        corr = df_clean[available_cols].corr()
-        sns.heatmap(corr, annot=True, cmap='coolwarm')
+        # من مصفوفة float32 الجاهزة بدل df.corr() الذي ينسخ إلى float64
+        corr = np.corrcoef(features.T)
+        sns.heatmap(corr, annot=True, cmap='coolwarm',
+                    xticklabels=available_cols, yticklabels=available_cols)
         plt.title('Heatmap للارتباطات بين الحساسات')
         plt.savefig('data_correlation.png', dpi=300, bbox_inches='tight')
-        plt.show()
+        plt.close()
         logger.info("تم حفظ الرسم في data_correlation.png")
 
 except FileNotFoundError:
@@ -1,18 +1,58 @@
 import paho.mqtt.client as mqtt
-from influxdb_client import InfluxDBClient, Point
-from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client import InfluxDBClient, WritePrecision
+from influxdb_client.client.write_api import WriteOptions, WriteType
 import json
-from threading import Thread
+import math
+import numpy as np
+from collections import deque
+from threading import Thread, Lock
 import time
 
+# orjson parses bytes directly and is much faster than json for small payloads
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 # InfluxDB settings
 INFLUX_URL = "http://influxdb:8086"
 INFLUX_TOKEN = "my-super-secret-token"
 INFLUX_ORG = "my_org"
 INFLUX_BUCKET = "electrolyzer_data"
 
-client = InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG)
-write_api = client.write_api(write_options=SYNCHRONOUS)
+# gzip the write bodies: line protocol repeats field names on every line and compresses well
+client = InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG, enable_gzip=True)
+# Batching writer: points are coalesced into one line-protocol body per request
+# instead of blocking the MQTT thread on an HTTP POST per point
+write_api = client.write_api(write_options=WriteOptions(
+    write_type=WriteType.batching,
+    batch_size=5000,
+    flush_interval=3000,
+    retry_interval=5000,
+    max_retries=3,
+    max_retry_delay=30000,
+    exponential_base=2))
+
+# Write batching: on_message only buffers messages, flush_loop classifies and writes them in bulk
+BATCH_SIZE = 5000 # messages per flush
+FLUSH_INTERVAL = 1 # seconds
+message_buffer = deque()
+buffer_lock = Lock()
+
+# Line protocol templates, formatted directly instead of building Point objects
+SENSOR_LINE = "electrolyzer_metrics,host=electrolyzer_1 temperature={t},voltage={v},current={c},conductivity={k} {ts}"
+AI_LINE = 'ai_predictions,host=electrolyzer_1 predicted_status="{status}",health_score={score}i {ts}'
+# Every message must carry these as finite numbers: one bad line would make InfluxDB reject the whole batch
+REQUIRED_FIELDS = ("temperature", "voltage", "current", "conductivity", "timestamp")
+
+def is_number(value):
+    # bool is an int subclass but not a valid line-protocol float, NaN/inf are rejected by InfluxDB
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+def lp_field(value):
+    # Same field type Point would write (ints get the i suffix), otherwise InfluxDB reports a type conflict
+    return f"{value}i" if isinstance(value, int) else repr(value)
 
 # MQTT settings
 MQTT_BROKER = "mosquitto"
@@ -24,56 +64,84 @@ THRESHOLD_VOLTAGE_HIGH = 2.2 # V
 THRESHOLD_CONDUCTIVITY_HIGH = 0.5 # mS/cm
 THRESHOLD_TEMP_HIGH = 90 # C
 
+# Checked in priority order: the first exceeded threshold decides the status code
+# (1 = water contamination, 2 = voltage anomaly, 3 = overheating)
+THRESHOLDS = np.array([THRESHOLD_CONDUCTIVITY_HIGH, THRESHOLD_VOLTAGE_HIGH, THRESHOLD_TEMP_HIGH])
+ALERT_MESSAGES = (None,
+                  "ALERT: High conductivity detected. Possible contamination!",
+                  "ALERT: High voltage detected. Possible degradation!",
+                  "ALERT: High temperature detected. Cooling issue!")
+
 def on_connect(client, userdata, flags, rc):
     print("Backend connected to MQTT Broker!")
     client.subscribe(MQTT_TOPIC)
 
 def on_message(client, userdata, msg):
-    payload = json.loads(msg.payload.decode('utf-8'))
+    payload = json_loads(msg.payload)
     print(f"Received: {payload}")
-    
-    # 1. Simple Anomaly Detection based on thresholds
-    status = "normal"
-    if payload["conductivity"] > THRESHOLD_CONDUCTIVITY_HIGH:
-        status = "water_contamination_alert"
-        print("ALERT: High conductivity detected. Possible contamination!")
-    elif payload["voltage"] > THRESHOLD_VOLTAGE_HIGH:
-        status = "voltage_anomaly_alert"
-        print("ALERT: High voltage detected. Possible degradation!")
-    elif payload["temperature"] > THRESHOLD_TEMP_HIGH:
-        status = "overheating_alert"
-        print("ALERT: High temperature detected. Cooling issue!")
-    
-    # 2. Integrate AI Model Prediction (Placeholder)
-    # This is where the AI team's code will go
-    # For now, we use a placeholder function
-    ai_prediction_status = "Normal"
-    health_score = 99
-    if status != "normal":
-        ai_prediction_status = "Anomaly Detected"
-        health_score = 45 # Lower the score for demo
-
-    # Write sensor data to InfluxDB
-    sensor_point = Point("electrolyzer_metrics") \
-        .tag("host", "electrolyzer_1") \
-        .field("temperature", payload["temperature"]) \
-        .field("voltage", payload["voltage"]) \
-        .field("current", payload["current"]) \
-        .field("conductivity", payload["conductivity"]) \
-        .time(payload["timestamp"], write_precision="s")
-    write_api.write(bucket=INFLUX_BUCKET, record=sensor_point)
-
-    # Write AI prediction to a separate measurement
-    ai_point = Point("ai_predictions") \
-        .tag("host", "electrolyzer_1") \
-        .field("predicted_status", ai_prediction_status) \
-        .field("health_score", health_score) \
-        .time(time.time(), write_precision="s")
-    write_api.write(bucket=INFLUX_BUCKET, record=ai_point)
-    
-    print("Data written to InfluxDB")
-
-mqtt_client = mqtt.Client()
+    if not isinstance(payload, dict) or not all(is_number(payload.get(f)) for f in REQUIRED_FIELDS):
+        print(f"Skipping message with missing or non-numeric fields: {payload}")
+        return
+
+    with buffer_lock:
+        message_buffer.append((payload, time.time_ns()))
+
+def classify(readings):
+    # readings is an (n, 3) array of conductivity, voltage, temperature.
+    # Returns one status code per row: 0 = normal, otherwise an index into ALERT_MESSAGES.
+    exceeded = readings > THRESHOLDS
+    return np.where(exceeded.any(axis=1), exceeded.argmax(axis=1) + 1, 0)
+
+def flush_points():
+    # Classify and write up to BATCH_SIZE buffered messages in one request, return how many were written
+    with buffer_lock:
+        batch = [message_buffer.popleft() for _ in range(min(BATCH_SIZE, len(message_buffer)))]
+    if not batch:
+        return 0
+
+    # 1. Simple Anomaly Detection based on thresholds, one vectorized pass per batch
+    readings = np.array([[p["conductivity"], p["voltage"], p["temperature"]] for p, _ in batch])
+    status_codes = classify(readings)
+
+    lines = []
+    for (payload, received_ns), code in zip(batch, status_codes.tolist()):
+        if code:
+            print(ALERT_MESSAGES[code])
+
+        # 2. Integrate AI Model Prediction (Placeholder)
+        # This is where the AI team's code will go
+        # For now, we use a placeholder function
+        ai_prediction_status = "Normal"
+        health_score = 99
+        if code:
+            ai_prediction_status = "Anomaly Detected"
+            health_score = 45 # Lower the score for demo
+
+        # Write sensor data to InfluxDB
+        lines.append(SENSOR_LINE.format(
+            t=lp_field(payload["temperature"]),
+            v=lp_field(payload["voltage"]),
+            c=lp_field(payload["current"]),
+            k=lp_field(payload["conductivity"]),
+            ts=int(payload["timestamp"] * 1e9)))
+
+        # Write AI prediction to a separate measurement
+        lines.append(AI_LINE.format(status=ai_prediction_status, score=health_score, ts=received_ns))
+
+    write_api.write(bucket=INFLUX_BUCKET, record=lines, write_precision=WritePrecision.NS)
+    print(f"Wrote {len(batch)} messages to InfluxDB")
+    return len(batch)
+
+def flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        try:
+            while flush_points() == BATCH_SIZE:
+                pass
+        except Exception as e:
+            print(f"Failed to write batch to InfluxDB: {e}")
+
+mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
 mqtt_client.on_connect = on_connect
 mqtt_client.on_message = on_message
 
@@ -81,7 +149,23 @@ def start_mqtt_listener():
     mqtt_client.connect(MQTT_BROKER, MQTT_PORT)
     mqtt_client.loop_forever()
 
+def shutdown():
+    mqtt_client.disconnect()
+    while flush_points():
+        pass
+    write_api.close() # flushes whatever the batching writer still holds
+    client.close()
+    print("Backend stopped, InfluxDB writes flushed")
+
 if __name__ == "__main__":
     mqtt_thread = Thread(target=start_mqtt_listener)
     mqtt_thread.start()
-    print("Backend is running...")
\ No newline at end of file
+    flush_thread = Thread(target=flush_loop, daemon=True)
+    flush_thread.start()
+    print("Backend is running...")
+    try:
+        mqtt_thread.join()
+    except KeyboardInterrupt:
+        print("Stopping backend...")
+    finally:
+        shutdown()
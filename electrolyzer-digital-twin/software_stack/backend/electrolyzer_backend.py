@@ -1,36 +1,66 @@
 import os
 import json
 import logging
-from datetime import datetime, timezone
+import math
 from typing import AsyncGenerator
 from contextlib import asynccontextmanager
+from collections import deque
 import asyncio
+import time
+import numpy as np
+import aiohttp
 from fastapi import FastAPI
 import uvicorn
 from dotenv import load_dotenv
-from influxdb_client import InfluxDBClient, Point
-from influxdb_client.client.write_api import ASYNCHRONOUS
+from influxdb_client import WritePrecision
+from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
 from influxdb_client.client.query_api import QueryApi
-import paho.mqtt.client as mqtt
-
-# محاولة import CallbackAPIVersion (لـ v2.x) مع fallback
-try:
-    from paho.mqtt import CallbackAPIVersion
-    CALLBACK_VERSION = CallbackAPIVersion.VERSION2
-    mqtt_version_msg = "Using paho-mqtt v2.x API (CallbackAPIVersion)"
-except ImportError:
-    CALLBACK_VERSION = None
-    mqtt_version_msg = "paho-mqtt v1.x detected. Using legacy API (VERSION1). Upgrade to v2.x for better features."
+from influxdb_client.rest import ApiException
+import aiomqtt
+from sensor_payload import decode_payload, timestamp_to_ns
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
-logger.info(mqtt_version_msg)  # Log للنسخة في البداية
 
 # Global variables
-mqtt_client = None
+# MQTT, InfluxDB writes and flushing all run on the FastAPI event loop, so no locks are needed
+mqtt_connected = False
 influx_client = None
 write_api = None
+mqtt_task = None
+flush_task = None
+
+# Write batching: the MQTT consumer only buffers messages, a background task classifies and flushes them
+BATCH_SIZE = 5000  # messages per flush
+FLUSH_INTERVAL = 1  # seconds
+MAX_RETRY_DELAY = 30  # seconds, backoff cap while InfluxDB keeps failing
+MQTT_RECONNECT_DELAY = 5  # seconds
+# Bounded so an InfluxDB outage cannot grow memory without limit: once full, the oldest messages are discarded
+MAX_BUFFERED = 100_000  # messages
+_point_buffer = deque(maxlen=MAX_BUFFERED)
+
+# Line protocol templates, formatted directly instead of building Point objects
+SENSOR_LINE = "electrolyzer_metrics,host=electrolyzer_1 temperature={t},voltage={v},current={c},conductivity={k} {ts}"
+AI_LINE = 'ai_predictions,host=electrolyzer_1 predicted_status="{status}",health_score={score}i {ts}'
+SENSOR_LINE_FIELDS = ("temperature", "voltage", "current", "conductivity")
+
+def is_number(value):
+    """True for finite int/float values; bool, None, strings and NaN/inf are not valid line-protocol floats."""
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+def lp_field(value):
+    """Format a numeric field value with the type Point would write: ints get the `i` suffix, floats stay floats.
+
+    The field types of an existing bucket are fixed (e.g. the default conductivity=0 has always been an
+    integer), so writing the other type would make InfluxDB reject the line with a field type conflict.
+    """
+    return f"{value}i" if isinstance(value, int) else repr(value)
+
+# Placeholder AI rule: anomaly when conductivity or voltage exceeds its threshold
+AI_THRESHOLDS = np.array([0.5, 2.05])  # conductivity (mS/cm), voltage (V)
+PREDICTED_STATUS = ("normal", "anomaly")
+HEALTH_SCORES = (100, 45)
 
 # InfluxDB setup
 async def setup_influxdb():
@@ -46,8 +76,9 @@ async def setup_influxdb():
     
     for attempt in range(5):
         try:
-            influx_client = InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG)
-            write_api = influx_client.write_api(write_options=ASYNCHRONOUS)
+            # gzip the batched line-protocol bodies, field names repeat on every line
+            influx_client = InfluxDBClientAsync(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG, enable_gzip=True)
+            write_api = influx_client.write_api()
             logger.info("Successfully connected to InfluxDB from Backend!")
             return True
         except Exception as e:
@@ -57,53 +88,78 @@ async def setup_influxdb():
     logger.error("Final failure in connecting to InfluxDB")
     return False
 
-# MQTT setup
-def on_mqtt_connect(client, userdata, flags, rc, properties=None):
-    if rc == 0:
-        logger.info("Successfully connected to MQTT Broker from Backend!")
-        MQTT_TOPIC_SENSORS = os.getenv("MQTT_TOPIC", "electrolyzer/sensors")
-        client.subscribe(MQTT_TOPIC_SENSORS)
-    else:
-        logger.error(f"MQTT connection failed (code: {rc})")
+def is_retryable(error):
+    """Connection errors, 429 and 5xx are transient; any other write error will fail the same way again."""
+    if isinstance(error, ApiException):
+        return error.status == 429 or (error.status or 0) >= 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, OSError))
+
+async def flush_points():
+    """Classify and write up to BATCH_SIZE buffered messages in a single call. Returns the number taken from the buffer.
 
-def on_mqtt_message(client, userdata, msg, properties=None):
+    WriteApiAsync does not retry, so on a transient failure the batch is put back at the head of the
+    buffer and the error is raised for the caller to back off. Batches rejected for good (e.g. 401, 404
+    bucket, 422 field type conflict) are logged and dropped so they cannot block the messages behind them.
+    """
+    batch = [_point_buffer.popleft() for _ in range(min(BATCH_SIZE, len(_point_buffer)))]
+    if not batch:
+        return 0
+
+    readings = np.array([(conductivity, voltage) for _, conductivity, voltage, _ in batch])
+    anomalies = (readings > AI_THRESHOLDS).any(axis=1)
+    lines = []
+    for (sensor_line, _, _, received_ns), is_anomaly in zip(batch, anomalies.tolist()):
+        lines.append(sensor_line)
+        lines.append(AI_LINE.format(status=PREDICTED_STATUS[is_anomaly],
+                                    score=HEALTH_SCORES[is_anomaly],
+                                    ts=received_ns))
+    if write_api:
+        try:
+            await write_api.write(bucket=INFLUX_BUCKET, record=lines, write_precision=WritePrecision.NS)
+        except Exception as e:
+            if not is_retryable(e):
+                logger.error(f"InfluxDB rejected a batch of {len(batch)} messages, dropping it: {e}")
+                return len(batch)
+            _point_buffer.extendleft(reversed(batch))
+            raise
+    return len(batch)
+
+async def flush_points_periodically():
+    delay = FLUSH_INTERVAL
+    while True:
+        await asyncio.sleep(delay)
+        try:
+            while await flush_points() == BATCH_SIZE:
+                pass
+            delay = FLUSH_INTERVAL
+        except Exception as e:
+            # exponential backoff while InfluxDB is unreachable
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+            logger.error(f"Failed to flush points to InfluxDB ({len(_point_buffer)} buffered), retrying in {delay}s: {e}")
+
+# MQTT setup
+def on_mqtt_message(payload):
     try:
-        payload = msg.payload.decode()
-        data = json.loads(payload)
+        data = decode_payload(payload)
         logger.info(f"Received sensor data: {data}")
         
         if write_api:
-            ts_str = data.get("timestamp")
-            if ts_str:
-                if 'Z' in ts_str:
-                    ts_str = ts_str.replace('Z', '+00:00')
-                point_time = datetime.fromisoformat(ts_str)
-            else:
-                point_time = datetime.now(timezone.utc)
-            
-            point = Point("electrolyzer_metrics") \
-                .tag("host", "electrolyzer_1") \
-                .field("temperature", data.get("temperature", 0)) \
-                .field("voltage", data.get("voltage", 0)) \
-                .field("current", data.get("current", 0)) \
-                .field("conductivity", data.get("conductivity", 0)) \
-                .time(point_time)
-            write_api.write(bucket=INFLUX_BUCKET, record=point)
-            logger.info("Sensor data written to InfluxDB.")
-
-            predicted_status = "normal"
-            health_score = 100
-            if data.get("conductivity", 0) > 0.5 or data.get("voltage", 0) > 2.05:
-                predicted_status = "anomaly"
-                health_score = 45
+            # Missing fields default to 0; anything else non-numeric (e.g. null) would make
+            # InfluxDB reject the whole batched write, so the message is skipped instead
+            t, v, c, k = (data.get(field, 0) for field in SENSOR_LINE_FIELDS)
+            if not all(is_number(x) for x in (t, v, c, k)):
+                logger.warning(f"Skipping message with non-numeric sensor fields: {data}")
+                return
+
+            now_ns = time.time_ns()
+            point_ns = timestamp_to_ns(data.get("timestamp"), now_ns)
             
-            ai_point = Point("ai_predictions") \
-                .tag("host", "electrolyzer_1") \
-                .field("predicted_status", predicted_status) \
-                .field("health_score", health_score) \
-                .time(datetime.now(timezone.utc))
-            write_api.write(bucket=INFLUX_BUCKET, record=ai_point)
-            logger.info("AI prediction written to InfluxDB.")
+            sensor_line = SENSOR_LINE.format(t=lp_field(t), v=lp_field(v), c=lp_field(c), k=lp_field(k),
+                                             ts=point_ns)
+
+            # AI prediction is computed per batch in flush_points
+            _point_buffer.append((sensor_line, k, v, now_ns))
+            logger.info("Sensor data buffered for InfluxDB.")
 
         else:
             logger.warning("InfluxDB API is not available.")
@@ -114,59 +170,59 @@ def on_mqtt_message(client, userdata, msg, properties=None):
     except Exception as e:
         logger.error(f"Failed to process MQTT message: {e}")
 
-async def setup_mqtt():
-    global mqtt_client
+async def mqtt_consumer():
+    """Consume sensor messages on the event loop, reconnecting whenever the broker connection drops."""
+    global mqtt_connected
     MQTT_BROKER = os.getenv("MQTT_BROKER", "localhost")
     MQTT_PORT = int(os.getenv("MQTT_PORT", 1883))
     MQTT_USER = os.getenv("MQTT_USER", "admin")
     MQTT_PASS = os.getenv("MQTT_PASS", "secret")
+    MQTT_TOPIC_SENSORS = os.getenv("MQTT_TOPIC", "electrolyzer/sensors")
     
-    if CALLBACK_VERSION:
-        mqtt_client = mqtt.Client(callback_api_version=CALLBACK_VERSION, client_id="backend_client")
-    else:
-        mqtt_client = mqtt.Client(client_id="backend_client")  # v1.x
-    
-    mqtt_client.username_pw_set(MQTT_USER, MQTT_PASS)
-    mqtt_client.on_connect = on_mqtt_connect
-    mqtt_client.on_message = on_mqtt_message
-    
-    for attempt in range(5):
+    while True:
         try:
-            mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
-            mqtt_client.loop_start()
-            logger.info("MQTT setup completed.")
-            return True
-        except Exception as e:
-            logger.warning(f"Attempt {attempt+1}: MQTT setup failed: {e}")
-            if attempt < 4:
-                await asyncio.sleep(5)
-    logger.error("Final MQTT connection failure.")
-    return False
+            async with aiomqtt.Client(MQTT_BROKER, MQTT_PORT, username=MQTT_USER, password=MQTT_PASS,
+                                      identifier="backend_client", keepalive=60) as client:
+                await client.subscribe(MQTT_TOPIC_SENSORS)
+                mqtt_connected = True
+                logger.info("Successfully connected to MQTT Broker from Backend!")
+                async for message in client.messages:
+                    on_mqtt_message(message.payload)
+        except aiomqtt.MqttError as e:
+            logger.warning(f"MQTT connection failed: {e}. Retrying in {MQTT_RECONNECT_DELAY}s")
+        finally:
+            mqtt_connected = False
+        await asyncio.sleep(MQTT_RECONNECT_DELAY)
 
 # Lifespan events (بديل لـ on_event)
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncGenerator:
     # Startup
+    global mqtt_task, flush_task
     influx_success = await setup_influxdb()
-    mqtt_success = await setup_mqtt()
-    INFLUX_BUCKET = os.getenv("INFLUX_BUCKET", "electrolyzer_data")
-    if not influx_success or not mqtt_success:
-        logger.error("One or more services failed to start. Check logs and .env file.")
-    else:
-        logger.info("All services started successfully!")
+    if not influx_success:
+        logger.error("InfluxDB failed to start. Check logs and .env file.")
+    mqtt_task = asyncio.create_task(mqtt_consumer())
+    flush_task = asyncio.create_task(flush_points_periodically())
+    logger.info("Backend services started.")
     yield  # يستمر التطبيق هنا
     # Shutdown
-    global mqtt_client, influx_client, write_api
-    if mqtt_client:
-        mqtt_client.loop_stop()
-        mqtt_client.disconnect()
-        logger.info("MQTT client disconnected.")
-    if write_api:
-        write_api.close()
-        logger.info("InfluxDB write API closed.")
-    if influx_client:
-        influx_client.close()
-        logger.info("InfluxDB client closed.")
+    global influx_client, write_api
+    for task in (mqtt_task, flush_task):
+        task.cancel()
+    await asyncio.gather(mqtt_task, flush_task, return_exceptions=True)
+    logger.info("MQTT consumer stopped.")
+    try:
+        if write_api:
+            while await flush_points():
+                pass
+            logger.info("Buffered points flushed to InfluxDB.")
+    except Exception as e:
+        logger.error(f"Failed to flush {len(_point_buffer)} buffered messages on shutdown: {e}")
+    finally:
+        if influx_client:
+            await influx_client.close()
+            logger.info("InfluxDB client closed.")
     logger.info("Backend connections closed.")
 
 # Config globals (يجب تعريفها هنا للوصول في endpoints)
@@ -180,13 +236,13 @@ def read_root():
     return {"message": "Electrolyzer Backend API is running!"}
 
 @app.get("/health")
-def health_check():
+async def health_check():
     status = {"status": "ok"}
     
     if influx_client:
         try:
             query_api = influx_client.query_api()
-            query_api.query(f'from(bucket: "{INFLUX_BUCKET}") |> limit(n:1)')
+            await query_api.query(f'from(bucket: "{INFLUX_BUCKET}") |> limit(n:1)')
             status["influxdb"] = "connected"
         except Exception as e:
             logger.warning(f"InfluxDB health check failed: {e}")
@@ -194,7 +250,7 @@ def health_check():
     else:
         status["influxdb"] = "not_connected"
     
-    if mqtt_client and mqtt_client.is_connected():
+    if mqtt_connected:
         status["mqtt"] = "connected"
     else:
         status["mqtt"] = "not_connected"
@@ -205,7 +261,7 @@ def health_check():
     return status
 
 @app.get("/data")
-def get_latest_data():
+async def get_latest_data():
     if not influx_client:
         return {"error": "InfluxDB not connected"}
     
@@ -218,7 +274,7 @@ def get_latest_data():
         |> last()
         |> yield(name: "last")
         '''
-        tables = query_api.query(query=query, org=INFLUX_ORG)
+        tables = await query_api.query(query=query, org=INFLUX_ORG)
         
         if tables:
             result = []
@@ -1,20 +1,21 @@
 import os
-import json
 import logging
-from datetime import datetime
-from typing import Dict, Any
+import time
+from typing import List
+from collections import deque
 import asyncio
 from fastapi import FastAPI, HTTPException, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from influxdb_client import InfluxDBClient, Point
+from influxdb_client import InfluxDBClient, Point, WritePrecision
 from influxdb_client.client.write_api import ASYNCHRONOUS  # محسن للأداء
-import paho.mqtt.client as mqtt
-from paho.mqtt import CallbackAPIVersion
+import aiomqtt
 from sklearn.ensemble import IsolationForest  # للـ AI
+import joblib
 import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
 from jose import JWTError, jwt  # لـ auth بسيط
+from sensor_payload import decode_payload, timestamp_to_ns  # payload ثنائي أو JSON من الـ Simulator
 
 # تحميل env vars
 load_dotenv()
@@ -30,17 +31,25 @@ MQTT_PORT = int(os.getenv("MQTT_PORT", 1883))
 MQTT_TOPIC = "electrolyzer/sensors"
 MQTT_USER = os.getenv("MQTT_USER", "admin")
 MQTT_PASS = os.getenv("MQTT_PASS", "secret")
+MQTT_RECONNECT_DELAY = 5  # ثوانٍ
 INFLUX_URL = os.getenv("INFLUX_URL", "http://influxdb:8086")
 INFLUX_TOKEN = os.getenv("INFLUX_TOKEN", "influx-token-2024")
 INFLUX_ORG = os.getenv("INFLUX_ORG", "electrolyzer")
 INFLUX_BUCKET = os.getenv("INFLUX_BUCKET", "electrolyzer_data")
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key")  # لـ JWT
+MODEL_PATH = os.getenv("MODEL_PATH", "isolation_forest_model.joblib")  # ناتج clean_data.py
+FEATURE_COLS = ("temperature", "pressure", "voltage", "current", "flow_rate")  # ترتيب features للـ model
+PREDICT_WINDOW = 256  # عدد آخر العينات التي يقيّمها /predict دفعة واحدة
 
 # Global vars
-mqtt_client = None
+# MQTT consumer يعمل كـ task على event loop الخاص بـ FastAPI (لا thread منفصل)، فـ _latest و latest_batch
+# يُعدلان فقط من الـ loop ولا حاجة لـ locks
+mqtt_task = None
 influx_client = None
 write_api = None
-latest_data: Dict[str, Any] = {}
+# آخر بيانات: الـ consumer يستبدل المرجع بـ dict جديد كامل، والـ endpoints تقرأ _latest[0] مباشرة
+_latest: list = [None]
+latest_batch: deque = deque(maxlen=PREDICT_WINDOW)  # (timestamp, features) لآخر العينات
 model = None  # AI model
 
 # InfluxDB setup مع retry
@@ -48,7 +57,8 @@ async def setup_influxdb():
     global influx_client, write_api
     for attempt in range(3):  # retry 3 مرات
         try:
-            influx_client = InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG)
+            # enable_gzip يضغط line protocol (أسماء الحقول تتكرر في كل سطر)
+            influx_client = InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG, enable_gzip=True)
             write_api = influx_client.write_api(write_options=ASYNCHRONOUS)
             logger.info("InfluxDB متصل بنجاح في Backend!")
             return True
@@ -58,24 +68,23 @@ async def setup_influxdb():
     logger.error("فشل نهائي في InfluxDB")
     return False
 
-# MQTT setup مع auth و retry
-def on_mqtt_connect(client, userdata, flags, rc, properties=None):
-    if rc == 0:
-        logger.info("MQTT متصل بنجاح في Backend!")
-        client.subscribe(MQTT_TOPIC)
-    else:
-        logger.error(f"فشل اتصال MQTT (code: {rc})")
-
-def on_mqtt_message(client, userdata, msg, properties=None):
-    global latest_data
+# معالجة رسالة MQTT واحدة (على event loop)
+def on_mqtt_message(payload: bytes):
     try:
-        data = json.loads(msg.payload.decode())
+        data = decode_payload(payload)
         logger.info(f"Received data via MQTT: {data}")
-        latest_data = data  # تحديث آخر بيانات (استخدم lock في production)
+        # features تُبنى هنا مرة واحدة كـ float32 حتى لا يعيد /predict بناءها، وقبل نشر العينة:
+        # رسالة غير صالحة (قيمة نصية أو null) تُرفض هنا ولا تصل إلى /sensors/latest أو /predict
+        features = np.array([data.get(col, 0) for col in FEATURE_COLS], dtype=np.float32)
+        if not np.isfinite(features).all():
+            raise ValueError(f"قيم حساسات غير رقمية: {data}")
+        _latest[0] = data
+        latest_batch.append((data.get("timestamp"), features))
 
         # حفظ في InfluxDB
         if write_api:
-            timestamp = data.get("timestamp", datetime.utcnow().isoformat())
+            # epoch ns/seconds أو ISO string، بنفس تحويل electrolyzer_backend
+            timestamp = timestamp_to_ns(data.get("timestamp"), time.time_ns())
             point = Point("sensor_data") \
                 .tag("source", "backend") \
                 .field("temperature", data.get("temperature", 0)) \
@@ -83,7 +92,7 @@ def on_mqtt_message(client, userdata, msg, properties=None):
                 .field("voltage", data.get("voltage", 0)) \
                 .field("current", data.get("current", 0)) \
                 .field("flow_rate", data.get("flow_rate", 0)) \
-                .time(timestamp)
+                .time(timestamp, write_precision=WritePrecision.NS)
             write_api.write(bucket=INFLUX_BUCKET, record=point)
             logger.info("تم حفظ البيانات في InfluxDB من Backend.")
         else:
@@ -91,35 +100,34 @@ def on_mqtt_message(client, userdata, msg, properties=None):
     except Exception as e:
         logger.error(f"فشل في معالجة MQTT message: {e}")
 
-async def setup_mqtt():
-    global mqtt_client
-    for attempt in range(3):
+# MQTT consumer مع auth و reconnect تلقائي
+async def mqtt_consumer():
+    while True:
         try:
-            mqtt_client = mqtt.Client(callback_api_version=CallbackAPIVersion.VERSION2, client_id="backend_client")
-            mqtt_client.username_pw_set(MQTT_USER, MQTT_PASS)  # auth
-            mqtt_client.on_connect = on_mqtt_connect
-            mqtt_client.on_message = on_mqtt_message
-            mqtt_client.reconnect_delay_set(min_delay=1, max_delay=120)  # retry auto
-            mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
-            mqtt_client.loop_start()
-            logger.info("MQTT setup مكتمل في Backend.")
-            return True
-        except Exception as e:
-            logger.warning(f"محاولة {attempt+1}: فشل setup MQTT: {e}")
-            await asyncio.sleep(5)
-    logger.error("فشل نهائي في MQTT")
-    return False
+            async with aiomqtt.Client(MQTT_BROKER, MQTT_PORT, username=MQTT_USER, password=MQTT_PASS,
+                                      identifier="backend_client", keepalive=60) as client:
+                await client.subscribe(MQTT_TOPIC)
+                logger.info("MQTT متصل بنجاح في Backend!")
+                async for message in client.messages:
+                    on_mqtt_message(message.payload)
+        except aiomqtt.MqttError as e:
+            logger.warning(f"فشل اتصال MQTT: {e}. إعادة المحاولة بعد {MQTT_RECONNECT_DELAY}s")
+        await asyncio.sleep(MQTT_RECONNECT_DELAY)
 
 # تحميل AI Model (Isolation Forest لكشف anomalies)
 def load_ai_model():
     global model
     try:
-        # افتراض: model محفوظ من clean_data.py
+        # model محفوظ من clean_data.py
+        if os.path.exists(MODEL_PATH):
+            model = joblib.load(MODEL_PATH)
+            logger.info(f"AI Model محمل من {MODEL_PATH}.")
+            return
+        # fallback فقط: model غير مفيد، مجرد حتى لا تتعطل الـ endpoints
+        logger.error(f"AI Model غير موجود في {MODEL_PATH}! شغل clean_data.py أو اضبط MODEL_PATH. استخدام model افتراضي.")
         model = IsolationForest(contamination=0.1, random_state=42)
-        # إذا لم يكن موجود، درب على بيانات افتراضية (أو load من file)
         sample_data = np.array([[70, 30, 48, 100, 5], [80, 35, 50, 110, 6]])  # temp, pressure, etc.
         model.fit(sample_data)
-        logger.info("AI Model محمل بنجاح.")
     except Exception as e:
         logger.error(f"فشل تحميل AI Model: {e}")
         model = None
@@ -127,8 +135,9 @@ def load_ai_model():
 # FastAPI startup
 @app.on_event("startup")
 async def startup_event():
+    global mqtt_task
     await setup_influxdb()
-    await setup_mqtt()
+    mqtt_task = asyncio.create_task(mqtt_consumer())
     load_ai_model()
 
 # Auth dependency (بسيط: JWT token)
@@ -145,45 +154,73 @@ def read_root():
     return {"message": "Electrolyzer Backend API جاهز! استخدم /sensors/latest أو /predict."}
 
 @app.get("/sensors/latest")
-def get_latest_sensors(current_user: dict = Depends(verify_token)):
-    if latest_data:
-        return latest_data
+async def get_latest_sensors(current_user: dict = Depends(verify_token)):
+    current = _latest[0]
+    if current:
+        return current
     raise HTTPException(status_code=404, detail="لا بيانات بعد. شغل Simulator.")
 
+def score_features(features: np.ndarray):
+    # استدعاء واحد vectorized لكل العينات بدل model.predict لكل صف
+    predictions = model.predict(features)
+    probs = model.decision_function(features)  # أقرب للـ anomaly أقل
+    health_scores = np.clip((1 - np.abs(probs)) * 100, 0, 100)  # تحويل إلى %
+    statuses = np.where(predictions == -1, "anomaly", "normal")
+    return statuses, health_scores, np.abs(probs)
+
 @app.get("/predict")
-def predict_anomaly(current_user: dict = Depends(verify_token)):
-    if not latest_data or not model:
+async def predict_anomaly(current_user: dict = Depends(verify_token)):
+    # نسخة من النافذة على الـ loop نفسه (لا تعديل متزامن)، ثم التقييم في thread حتى لا يتوقف الـ consumer
+    window = list(latest_batch)
+    if not window or not model:
         raise HTTPException(status_code=400, detail="لا بيانات أو model غير محمل.")
     
-    # استخراج features
-    features = np.array([[latest_data.get("temperature", 0),
-                          latest_data.get("pressure", 0),
-                          latest_data.get("voltage", 0),
-                          latest_data.get("current", 0),
-                          latest_data.get("flow_rate", 0)]])
-    
-    prediction = model.predict(features)[0]
-    prob = model.decision_function(features)[0]  # أقرب للـ anomaly أقل
-    health_score = max(0, min(100, (1 - abs(prob)) * 100))  # تحويل إلى %
-    status = "anomaly" if prediction == -1 else "normal"
+    # استخراج features لكل النافذة (k, 5)
+    timestamps = [ts for ts, _ in window]
+    features = np.stack([f for _, f in window])
+    statuses, health_scores, probs = await asyncio.to_thread(score_features, features)
+    status = str(statuses[-1])
+    health_score = float(health_scores[-1])
     
     # حفظ في InfluxDB
     if write_api:
         point = Point("ai_predictions") \
             .field("health_score", health_score) \
             .field("predicted_status", status) \
-            .time(datetime.utcnow().isoformat())
+            .time(time.time_ns(), write_precision=WritePrecision.NS)
         write_api.write(bucket=INFLUX_BUCKET, record=point)
     
-    return {"status": status, "health_score": health_score, "probability": abs(prob)}
+    return {
+        "status": status,
+        "health_score": health_score,
+        "probability": float(probs[-1]),
+        "window": [
+            {"timestamp": ts, "status": st, "health_score": hs}
+            for ts, st, hs in zip(timestamps, statuses.tolist(), health_scores.tolist())
+        ],
+    }
+
+@app.post("/predict_batch")
+def predict_anomaly_batch(samples: List[List[float]], current_user: dict = Depends(verify_token)):
+    if not model:
+        raise HTTPException(status_code=400, detail="model غير محمل.")
+    if not samples or any(len(sample) != len(FEATURE_COLS) for sample in samples):
+        raise HTTPException(status_code=422, detail=f"كل عينة يجب أن تحتوي {len(FEATURE_COLS)} قيم: {list(FEATURE_COLS)}")
+    
+    features = np.asarray(samples, dtype=np.float32)
+    statuses, health_scores, probs = score_features(features)
+    return [
+        {"status": st, "health_score": hs, "probability": pr}
+        for st, hs, pr in zip(statuses.tolist(), health_scores.tolist(), probs.tolist())
+    ]
 
 # Shutdown
 @app.on_event("shutdown")
 async def shutdown_event():
-    global mqtt_client, influx_client, write_api
-    if mqtt_client:
-        mqtt_client.loop_stop()
-        mqtt_client.disconnect()
+    global influx_client, write_api
+    if mqtt_task:
+        mqtt_task.cancel()
+        await asyncio.gather(mqtt_task, return_exceptions=True)
     if write_api:
         write_api.close()
     if influx_client:
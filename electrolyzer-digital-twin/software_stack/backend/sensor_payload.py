@@ -0,0 +1,41 @@
+"""Sensor payload decoding shared by the MQTT consumers in main.py and electrolyzer_backend.py."""
+import json
+import struct
+from datetime import datetime, timezone
+
+# orjson parses bytes directly and is much faster than json for small payloads
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Binary payload published by the simulator: 5 x float32 sensor values + uint64 epoch ns (28 bytes)
+SENSOR_STRUCT = struct.Struct('<5fQ')
+SENSOR_FIELDS = ("temperature", "pressure", "voltage", "current", "flow_rate", "timestamp")
+EPOCH_NS_MIN = 1e15  # numeric timestamps above this are epoch ns, below it epoch seconds
+
+def decode_payload(payload):
+    """Decode a binary simulator payload, or a JSON object (simulator DEBUG mode or other sources).
+
+    A JSON object can be exactly SENSOR_STRUCT.size bytes long too, so the size alone does not
+    identify the format. JSON objects end with `}`; the last byte of a binary payload is the high
+    byte of the little-endian ns timestamp, which stays far below 0x7d (`}`) until the year 2255.
+    """
+    if len(payload) == SENSOR_STRUCT.size and not payload.rstrip().endswith(b'}'):
+        *values, ts = SENSOR_STRUCT.unpack(payload)
+        # float32 widens 70.12 to 70.12000274658203; the simulator sends values rounded to 2 decimals
+        return dict(zip(SENSOR_FIELDS, [round(v, 2) for v in values] + [ts]))
+    return json_loads(payload)
+
+def timestamp_to_ns(ts, default_ns):
+    """Convert a payload timestamp (epoch ns, epoch seconds or ISO 8601 string) to integer nanoseconds."""
+    if isinstance(ts, (int, float)):
+        # numeric: no parsing needed
+        return int(ts) if ts > EPOCH_NS_MIN else int(ts * 1e9)
+    if not ts:
+        return default_ns
+    point_time = datetime.fromisoformat(ts.replace('Z', '+00:00'))
+    if point_time.tzinfo is None:
+        point_time = point_time.replace(tzinfo=timezone.utc)
+    return int(point_time.timestamp() * 1e9)
@@ -2,82 +2,120 @@ import paho.mqtt.client as mqtt
 import time
 import json
 import random
+import numpy as np
+
+# orjson serializes straight to bytes and is much faster than json
+try:
+    import orjson
+    json_dumps = orjson.dumps
+except ImportError:
+    json_dumps = json.dumps
+
+# numba compiles the numeric generator; without it the same code runs as plain Python
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda func: func
 
 # MQTT Broker settings
 BROKER = "localhost"
 PORT = 1883
 TOPIC = "electrolyzer/data"
 
-client = mqtt.Client()
-
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
         print("Connected to MQTT Broker!")
     else:
         print("Failed to connect, return code %d\n", rc)
 
-client.on_connect = on_connect
-client.connect(BROKER, PORT)
-
 # Global variables to simulate state and failure scenarios
 failure_scenario = "normal"
 time_to_fail = time.time() + 60 * 5 # Introduce a failure after 5 minutes
 
-# Function to simulate sensor data based on a scenario
-def generate_data(scenario):
+# Integer scenario codes used by the compiled generator
+SCENARIOS = ("normal", "chemical_pollution", "electrode_corrosion", "cooling_failure")
+SCENARIO_IDS = {name: code for code, name in enumerate(SCENARIOS)}
+
+# Simulate one sample as [temperature, voltage, current, conductivity].
+# elapsed is the number of seconds since time_to_fail (negative before the failure).
+@njit(cache=True)
+def _gen_numeric(scenario_id, elapsed):
     base_temp = 75
     base_voltage = 1.9
     base_current = 550
     base_conductivity = 0.3
-    
-    # Simulate normal operation with slight variations
-    if scenario == "normal":
-        temp = base_temp + random.uniform(-1, 1)
-        voltage = base_voltage + random.uniform(-0.02, 0.02)
-        current = base_current + random.uniform(-5, 5)
-        conductivity = base_conductivity + random.uniform(-0.01, 0.01)
 
     # 1. Chemical Pollution (تلوث كيميائي)
-    elif scenario == "chemical_pollution":
-        temp = base_temp + random.uniform(-1, 1)
-        voltage = base_voltage + random.uniform(0.1, 0.2) 
-        current = base_current + random.uniform(-5, 5)
-        conductivity = base_conductivity + 0.05 * (time.time() - time_to_fail) / 60
+    if scenario_id == 1:
+        temp = base_temp + np.random.uniform(-1, 1)
+        voltage = base_voltage + np.random.uniform(0.1, 0.2)
+        current = base_current + np.random.uniform(-5, 5)
+        conductivity = base_conductivity + 0.05 * elapsed / 60
         conductivity = max(conductivity, 0.5) # Reaching threshold
-        
+
     # 2. Electrode Corrosion (تآكل الأقطاب)
-    elif scenario == "electrode_corrosion":
-        temp = base_temp + random.uniform(-1, 1)
-        voltage = base_voltage + 0.05 * (time.time() - time_to_fail) / 60
+    elif scenario_id == 2:
+        temp = base_temp + np.random.uniform(-1, 1)
+        voltage = base_voltage + 0.05 * elapsed / 60
         voltage = max(voltage, 2.0) # Voltage increases over time
-        current = base_current + random.uniform(-5, 5)
-        conductivity = base_conductivity + random.uniform(-0.01, 0.01)
+        current = base_current + np.random.uniform(-5, 5)
+        conductivity = base_conductivity + np.random.uniform(-0.01, 0.01)
 
     # 3. Cooling Failure (ضعف التبريد)
-    elif scenario == "cooling_failure":
-        temp = base_temp + 0.5 * (time.time() - time_to_fail)
+    elif scenario_id == 3:
+        temp = base_temp + 0.5 * elapsed
         voltage = base_voltage + (temp - base_temp) * 0.01 # Voltage increases with temperature
-        current = base_current + random.uniform(-5, 5)
-        conductivity = base_conductivity + random.uniform(-0.01, 0.01)
+        current = base_current + np.random.uniform(-5, 5)
+        conductivity = base_conductivity + np.random.uniform(-0.01, 0.01)
 
+    # Simulate normal operation with slight variations
+    else:
+        temp = base_temp + np.random.uniform(-1, 1)
+        voltage = base_voltage + np.random.uniform(-0.02, 0.02)
+        current = base_current + np.random.uniform(-5, 5)
+        conductivity = base_conductivity + np.random.uniform(-0.01, 0.01)
+
+    return np.array([temp, voltage, current, conductivity])
+
+@njit(cache=True)
+def _gen_batch(scenario_id, elapsed_start, n, interval):
+    out = np.empty((n, 4))
+    for i in range(n):
+        out[i] = _gen_numeric(scenario_id, elapsed_start + i * interval)
+    return out
+
+# Function to simulate sensor data based on a scenario
+def generate_data(scenario):
+    now = time.time()
+    temp, voltage, current, conductivity = np.round(
+        _gen_numeric(SCENARIO_IDS[scenario], now - time_to_fail), 2).tolist()
     return {
-        "temperature": round(temp, 2),
-        "voltage": round(voltage, 2),
-        "current": round(current, 2),
-        "conductivity": round(conductivity, 2),
-        "timestamp": time.time(),
+        "temperature": temp,
+        "voltage": voltage,
+        "current": current,
+        "conductivity": conductivity,
+        "timestamp": now,
         "scenario": scenario
     }
 
+# Back-fill historical data: n samples every `interval` seconds starting at epoch `start`.
+# Returns an (n, 4) array of temperature, voltage, current, conductivity.
+def backfill(scenario, start, n, interval=5.0):
+    return _gen_batch(SCENARIO_IDS[scenario], start - time_to_fail, n, interval)
+
 # Main loop
-client.loop_start()
-while True:
-    if time.time() > time_to_fail and failure_scenario == "normal":
-        failure_scenario = random.choice(["chemical_pollution", "electrode_corrosion", "cooling_failure"])
-        print(f"--- FAILED SCENARIO ACTIVATED: {failure_scenario} ---")
-
-    data = generate_data(failure_scenario)
-    client.publish(TOPIC, json.dumps(data))
-    print(f"Published: {data}")
-    time.sleep(5)
-    
\ No newline at end of file
+if __name__ == "__main__":
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+    client.on_connect = on_connect
+    client.connect(BROKER, PORT)
+    client.loop_start()
+    while True:
+        if time.time() > time_to_fail and failure_scenario == "normal":
+            failure_scenario = random.choice(["chemical_pollution", "electrode_corrosion", "cooling_failure"])
+            print(f"--- FAILED SCENARIO ACTIVATED: {failure_scenario} ---")
+
+        data = generate_data(failure_scenario)
+        client.publish(TOPIC, json_dumps(data))
+        print(f"Published: {data}")
+        time.sleep(5)
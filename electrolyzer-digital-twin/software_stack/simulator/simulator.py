@@ -1,18 +1,35 @@
 import os
 import time
-import json
-import random
+import struct
+import socket
+import queue
+import threading
+from urllib.parse import urlparse
 import numpy as np
-from datetime import datetime
 import paho.mqtt.client as mqtt
-from paho.mqtt import CallbackAPIVersion
-from influxdb_client import InfluxDBClient, Point
-from influxdb_client.client.write_api import ASYNCHRONOUS
+from influxdb_client import InfluxDBClient, WritePrecision
+from influxdb_client.client.write_api import WriteOptions, WriteType
 from dotenv import load_dotenv
 import logging
 
+# orjson (C) لـ JSON payload في وضع DEBUG، وإلا PAYLOAD_TEMPLATE
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# numba يترجم fill() لوضع HIGH_RATE؛ بدونه نفس الكود يعمل كـ Python عادي
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+    def njit(*args, **kwargs):
+        return lambda func: func
+
 load_dotenv()
-logging.basicConfig(level=logging.INFO)
+# WARNING افتراضيًا في الإنتاج؛ LOG_LEVEL=DEBUG لرؤية كل عينة
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper())
 logger = logging.getLogger(__name__)
 
 # Config
@@ -21,14 +38,97 @@ MQTT_PORT = int(os.getenv("MQTT_PORT", 1883))
 MQTT_TOPIC = "electrolyzer/sensors"
 MQTT_USER = os.getenv("MQTT_USER", "admin")
 MQTT_PASS = os.getenv("MQTT_PASS", "secret")
+DEBUG = os.getenv("DEBUG", "false").lower() in ("1", "true", "yes")  # JSON payload مقروء للبشر
+MQTT_SNDBUF = 1 << 20  # 1 MiB send buffer
+SAMPLE_INTERVAL = float(os.getenv("SAMPLE_INTERVAL", 5.0))  # ثوانٍ بين العينات
+# وضع المعدل العالي (replay/load test): عينات مولدة مسبقًا بكتل، عادةً مع SAMPLE_INTERVAL صغير
+HIGH_RATE = os.getenv("HIGH_RATE", "false").lower() in ("1", "true", "yes")
+BLOCK_ROWS = 100_000
+# أقصى تأخر (بعدد العينات) يُعوض بعينات متتالية فورية؛ أكثر من ذلك يُعاد ضبط الجدول من الآن
+MAX_LAG_TICKS = 10
+if HIGH_RATE and not HAS_NUMBA:
+    # fill() كـ Python عادي يستغرق ~1s لكل كتلة ويوقف حلقة التوليد
+    logger.warning("HIGH_RATE مفعل بدون numba: كل كتلة %d عينة ستُولد ببطء، ثبّت numba", BLOCK_ROWS)
 INFLUX_URL = os.getenv("INFLUX_URL", "http://influxdb:8086")
 INFLUX_TOKEN = os.getenv("INFLUX_TOKEN", "influx-token-2024")
 INFLUX_ORG = os.getenv("INFLUX_ORG", "electrolyzer")
 INFLUX_BUCKET = os.getenv("INFLUX_BUCKET", "electrolyzer_data")
+# UDP line protocol اختياري (INFLUX_UDP_PORT=8089 مثلًا): أخف من HTTP لكن بدون تأكيد استلام
+# InfluxDB 2.x لا يملك UDP listener؛ الهدف Telegraf socket_listener أو InfluxDB 1.x [[udp]]
+# 0 (الافتراضي) = HTTP write_api
+INFLUX_UDP_PORT = int(os.getenv("INFLUX_UDP_PORT", 0))
+INFLUX_UDP_HOST = os.getenv("INFLUX_UDP_HOST", urlparse(INFLUX_URL).hostname)
+
+# measurement + tag ثابتة: line protocol يُكتب مباشرة بدل بناء Point لكل عينة
+LP_PREFIX = "sensor_data,source=simulator "
+# الأسطر تُجمع وتُرسل كقائمة واحدة: كل 100 سطر أو كل 10 ثوانٍ، أيهما أولًا
+LP_BATCH_SIZE = 100
+LP_FLUSH_INTERVAL = 10.0  # ثوانٍ
+_LP_BATCH: list[str] = []  # يستخدمه influx_worker فقط
+_lp_last_flush = time.monotonic()
+
+# كل sink له طابور و thread: تعطل أحدهما (broker back-pressure أو HTTP بطيء) لا يوقف الآخر ولا المولد
+# الطوابير محدودة: عند الامتلاء تُسقط العينة بدل أن ينتظر المولد
+SINK_QUEUE_SIZE = 10_000
+_MQTT_Q = queue.Queue(maxsize=SINK_QUEUE_SIZE)
+_INFLUX_Q = queue.Queue(maxsize=SINK_QUEUE_SIZE)
+_dropped = {"mqtt": 0, "influx": 0}
+_publish_errors = 0  # rc != 0 من publish (يُسجل الأول فقط)
+
+# توزيع الحساسات: temperature, pressure, voltage, current, flow_rate
+RNG = np.random.default_rng()
+MEANS = np.array([70, 30, 48, 100, 5], dtype=np.float64)
+STDS = np.array([5, 2, 2, 10, 0.5], dtype=np.float64)
+_VALS = np.empty(5, dtype=np.float64)  # buffer واحد يُعاد استخدامه لكل عينة
+
+# Anomalies بكود رقمي k: موقع الحساس في vals ومقدار التغيير (الاسم للـ log فقط)
+ANOMALY_LABELS = ('voltage_drop', 'temp_spike', 'pressure_leak')
+ANOMALY_IDX = np.array([2, 0, 1], dtype=np.int8)
+ANOMALY_DELTA = np.array([-10.0, 20.0, -8.0])
+
+# JSON payload كـ bytes جاهزة (fallback بدون orjson): %.2f بدل json.dumps لكل عينة
+PAYLOAD_TEMPLATE = (b'{"temperature":%.2f,"pressure":%.2f,"voltage":%.2f,'
+                    b'"current":%.2f,"flow_rate":%.2f,"timestamp":%d}')
+
+# MQTT payload ثنائي (الافتراضي): 5 x float32 للحساسات + uint64 epoch ns = 28 bytes
+# المستهلكون (backend) يفكونه بنفس الصيغة
+_pack = struct.Struct('<5fQ').pack
+
+# توليد كتلة كاملة في loop مُجمّع: Box-Muller + anomalies بنفس توزيع generate_sensor_data
+# out بتخطيط SoA: out[j, i] = الحساس j في العينة i (صف لكل حساس)
+@njit(cache=True)
+def fill(out, n, seed):
+    np.random.seed(seed)
+    for i in range(n):
+        for j in range(5):
+            u1 = 1.0 - np.random.random()  # (0, 1] لتجنب log(0)
+            u2 = np.random.random()
+            z = np.sqrt(-2.0 * np.log(u1)) * np.cos(2.0 * np.pi * u2)
+            out[j, i] = MEANS[j] + STDS[j] * z
+        if np.random.random() < 0.15:
+            k = np.random.randint(0, 3)
+            out[ANOMALY_IDX[k], i] += ANOMALY_DELTA[k]
+
+_BLOCK = np.empty((5, BLOCK_ROWS), dtype=np.float32) if HIGH_RATE else None
+_block_pos = BLOCK_ROWS  # الكتلة الأولى تُولد عند أول عينة
+_block_seed = int(RNG.integers(1 << 31))
+
+def next_block_sample():
+    # العينة التالية من الكتلة إلى _VALS، مع إعادة التوليد عند نفادها
+    global _block_pos, _block_seed
+    if _block_pos == BLOCK_ROWS:
+        fill(_BLOCK, BLOCK_ROWS, _block_seed)
+        _block_seed += 1
+        _block_pos = 0
+    _VALS[:] = _BLOCK[:, _block_pos]
+    _block_pos += 1
+    return _VALS
 
 mqtt_client = None
+_mqtt_publish = None  # mqtt_client.publish محفوظة مسبقًا لتجنب attribute lookup لكل عينة
 influx_client = None
 write_api = None
+_udp_sock = None
 mqtt_connected = False
 influx_connected = False
 
@@ -37,110 +137,205 @@ def on_mqtt_connect(client, userdata, flags, rc, properties=None):
     global mqtt_connected
     if rc == 0:
         logger.info("MQTT متصل بنجاح في Simulator!")
+        # تعطيل Nagle وتكبير send buffer (مع QoS 0 لا يوجد انتظار ack) - يُعاد بعد كل reconnect
+        sock = client.socket()
+        if sock is not None:
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, MQTT_SNDBUF)
+            except OSError as e:
+                logger.warning("تعذر ضبط خيارات socket لـ MQTT: %s", e)
         mqtt_connected = True
     else:
-        logger.error(f"فشل اتصال MQTT (code: {rc})")
+        logger.error("فشل اتصال MQTT (code: %s)", rc)
         mqtt_connected = False
 
 try:
-    mqtt_client = mqtt.Client(callback_api_version=CallbackAPIVersion.VERSION2, client_id="simulator_client")
+    mqtt_client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2, client_id="simulator_client")
     mqtt_client.username_pw_set(MQTT_USER, MQTT_PASS)
     mqtt_client.on_connect = on_mqtt_connect
     mqtt_client.reconnect_delay_set(min_delay=1, max_delay=120)
     mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
     mqtt_client.loop_start()
+    _mqtt_publish = mqtt_client.publish
     logger.info("MQTT setup في Simulator.")
 except Exception as e:
-    logger.error(f"فشل MQTT في Simulator: {e}")
+    logger.error("فشل MQTT في Simulator: %s", e)
     mqtt_client = None
 
 # InfluxDB setup
-try:
-    influx_client = InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG)
-    write_api = influx_client.write_api(write_options=ASYNCHRONOUS)
+if INFLUX_UDP_PORT:
+    # socket واحد بدون bind؛ sendto لكل دفعة
+    _udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     influx_connected = True
-    logger.info("InfluxDB متصل بنجاح في Simulator!")
-except Exception as e:
-    logger.error(f"فشل InfluxDB في Simulator: {e}")
-    influx_client = None
-    write_api = None
+    logger.info("InfluxDB عبر UDP: %s:%d", INFLUX_UDP_HOST, INFLUX_UDP_PORT)
+else:
+    try:
+        influx_client = InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG)
+        # batching: المكتبة تجمع النقاط في الخلفية وترسلها دفعة واحدة بدل طلب HTTP لكل نقطة
+        write_api = influx_client.write_api(write_options=WriteOptions(
+            write_type=WriteType.batching,
+            batch_size=500,
+            flush_interval=5_000,
+            jitter_interval=1_000,
+        ))
+        influx_connected = True
+        logger.info("InfluxDB متصل بنجاح في Simulator!")
+    except Exception as e:
+        logger.error("فشل InfluxDB في Simulator: %s", e)
+        influx_client = None
+        write_api = None
+
+def flush_lp_batch():
+    # استدعاء write واحد (أو datagram واحد عبر UDP) لكل الأسطر المجمعة
+    global _lp_last_flush
+    _lp_last_flush = time.monotonic()
+    if not _LP_BATCH:
+        return
+    try:
+        if _udp_sock:
+            # 100 سطر ≈ 11 KB، أقل من حد datagram (64 KB)
+            _udp_sock.sendto("\n".join(_LP_BATCH).encode(), (INFLUX_UDP_HOST, INFLUX_UDP_PORT))
+        else:
+            write_api.write(bucket=INFLUX_BUCKET, record=_LP_BATCH, write_precision=WritePrecision.NS)
+        logger.debug("تم حفظ %d سطر في InfluxDB.", len(_LP_BATCH))
+    except Exception as e:
+        logger.error("فشل في حفظ InfluxDB: %s", e)
+    _LP_BATCH.clear()
+
+def enqueue(q, item, sink):
+    try:
+        q.put_nowait(item)
+    except queue.Full:
+        _dropped[sink] += 1
+        n = _dropped[sink]
+        if n == 1 or n % 1000 == 0:
+            logger.warning("طابور %s ممتلئ، عدد العينات المسقطة: %d", sink, n)
+
+def mqtt_worker():
+    global _publish_errors
+    while True:
+        payload = _MQTT_Q.get()
+        if payload is None:
+            return
+        try:
+            # QoS 0 صريح وبدون retain: لا انتظار PUBACK ولا حالة inflight، ولا wait_for_publish أبدًا
+            result = _mqtt_publish(MQTT_TOPIC, payload, qos=0, retain=False)
+            # rc استشاري فقط (مثل NO_CONN أثناء reconnect): عدّ بدون log لكل رسالة
+            if result.rc:
+                _publish_errors += 1
+                if _publish_errors == 1:
+                    logger.error("فشل MQTT publish: %s (الأخطاء التالية تُعد فقط)", result.rc)
+        except Exception as e:
+            logger.error("فشل إرسال MQTT: %s", e)
+
+def influx_worker():
+    # يجمع الأسطر في _LP_BATCH حتى LP_BATCH_SIZE أو LP_FLUSH_INTERVAL ثم write واحد
+    while True:
+        timeout = LP_FLUSH_INTERVAL - (time.monotonic() - _lp_last_flush)
+        try:
+            lp = _INFLUX_Q.get(timeout=max(timeout, 0))
+        except queue.Empty:
+            flush_lp_batch()
+            continue
+        if lp is None:
+            flush_lp_batch()
+            return
+        _LP_BATCH.append(lp)
+        if len(_LP_BATCH) >= LP_BATCH_SIZE:
+            flush_lp_batch()
+
+def stop_worker(q, thread):
+    # None كعلامة توقف بعد آخر عينة في الطابور، ثم انتظار تفريغه
+    if thread is None:
+        return
+    try:
+        q.put(None, timeout=5)
+        thread.join(timeout=10)
+    except queue.Full:
+        logger.warning("تعذر إيقاف worker: الطابور ما زال ممتلئًا")
+
+_mqtt_thread = None
+_influx_thread = None
+if mqtt_client:
+    _mqtt_thread = threading.Thread(target=mqtt_worker, name="mqtt-sink", daemon=True)
+    _mqtt_thread.start()
+if influx_connected:
+    _influx_thread = threading.Thread(target=influx_worker, name="influx-sink", daemon=True)
+    _influx_thread.start()
 
 def generate_sensor_data():
-    # توليد بيانات واقعية لـ Electrolyzer
-    base_temp = np.random.normal(70, 5)  # درجة حرارة
-    base_pressure = np.random.normal(30, 2)  # ضغط
-    base_voltage = np.random.normal(48, 2)  # جهد
-    base_current = np.random.normal(100, 10)  # تيار
-    base_flow = np.random.normal(5, 0.5)  # تدفق H2
-    
-    # Anomalies واقعية (15% احتمال)
-    if random.random() < 0.15:
-        anomaly_type = random.choice(['voltage_drop', 'temp_spike', 'pressure_leak'])
-        if anomaly_type == 'voltage_drop':
-            base_voltage -= 10  # انخفاض جهد (عطل)
-            logger.warning(f"Anomaly: voltage_drop")
-        elif anomaly_type == 'temp_spike':
-            base_temp += 20  # ارتفاع حرارة
-            logger.warning(f"Anomaly: temp_spike")
-        elif anomaly_type == 'pressure_leak':
-            base_pressure -= 8  # تسرب
-            logger.warning(f"Anomaly: pressure_leak")
+    # توليد بيانات واقعية لـ Electrolyzer (استدعاء واحد للحساسات الخمسة، داخل _VALS بدون allocation)
+    if HIGH_RATE:
+        # anomalies مطبقة مسبقًا في fill() (بدون log لكل عينة)
+        vals = next_block_sample()
+    else:
+        vals = RNG.standard_normal(out=_VALS)
+        vals *= STDS
+        vals += MEANS
+        
+        # Anomalies واقعية (15% احتمال): انخفاض جهد، ارتفاع حرارة، أو تسرب ضغط
+        if RNG.random() < 0.15:
+            k = RNG.integers(0, 3)
+            vals[ANOMALY_IDX[k]] += ANOMALY_DELTA[k]
+            logger.warning("Anomaly: %s", ANOMALY_LABELS[k])
     
-    timestamp = datetime.utcnow().isoformat()
-    data = {
-        "temperature": round(base_temp, 2),
-        "pressure": round(base_pressure, 2),
-        "voltage": round(base_voltage, 2),
-        "current": round(base_current, 2),
-        "flow_rate": round(base_flow, 2),
-        "timestamp": timestamp
-    }
+    np.round(vals, 2, out=vals)
+    temp, pressure, voltage, current, flow = vals.tolist()
+    ns = time.time_ns()  # timestamp واحد (epoch ns) لـ MQTT و InfluxDB
     
-    # إرسال MQTT
+    # إرسال MQTT (عبر mqtt_worker)
     if mqtt_client and mqtt_connected:
-        try:
-            payload = json.dumps(data)
-            result = mqtt_client.publish(MQTT_TOPIC, payload)
-            if result.rc == 0:
-                logger.info(f"Sent data via MQTT: {data}")
-            else:
-                logger.error(f"فشل MQTT publish: {result.rc}")
-        except Exception as e:
-            logger.error(f"فشل إرسال MQTT: {e}")
+        if DEBUG and orjson:
+            # القيم مقربة مسبقًا بـ np.round، و orjson يكتب أقصر تمثيل (70.12 وليس 70.12000000000001)
+            payload = orjson.dumps({"temperature": temp, "pressure": pressure, "voltage": voltage,
+                                    "current": current, "flow_rate": flow, "timestamp": ns})
+        elif DEBUG:
+            payload = PAYLOAD_TEMPLATE % (temp, pressure, voltage, current, flow, ns)
+        else:
+            payload = _pack(temp, pressure, voltage, current, flow, ns)
+        enqueue(_MQTT_Q, payload, "mqtt")
     else:
-        logger.warning(f"MQTT غير متاح – البيانات محليًا: {data}")
+        logger.warning("MQTT غير متاح – البيانات محليًا: temperature=%s pressure=%s voltage=%s "
+                       "current=%s flow_rate=%s timestamp=%d", temp, pressure, voltage, current, flow, ns)
     
-    # حفظ InfluxDB
-    if influx_connected and write_api:
-        try:
-            point = Point("sensor_data") \
-                .tag("source", "simulator") \
-                .field("temperature", data["temperature"]) \
-                .field("pressure", data["pressure"]) \
-                .field("voltage", data["voltage"]) \
-                .field("current", data["current"]) \
-                .field("flow_rate", data["flow_rate"]) \
-                .time(timestamp)
-            write_api.write(bucket=INFLUX_BUCKET, record=point)
-            logger.info("تم حفظ البيانات في InfluxDB بنجاح.")
-        except Exception as e:
-            logger.error(f"فشل في حفظ InfluxDB: {e}")
+    # حفظ InfluxDB (عبر influx_worker)
+    if influx_connected:
+        enqueue(_INFLUX_Q, f"{LP_PREFIX}temperature={temp},pressure={pressure},"
+                           f"voltage={voltage},current={current},flow_rate={flow} {ns}", "influx")
     else:
         logger.warning("InfluxDB غير متاح – البيانات محليًا فقط.")
-    
-    logger.info("-" * 50)  # فاصل للوضوح
 
 if __name__ == "__main__":
     logger.info("Starting Electrolyzer Simulator...")
-    logger.info(f"حالة MQTT: {'متصل' if mqtt_connected else 'غير متصل'}")
-    logger.info(f"حالة InfluxDB: {'متصل' if influx_connected else 'غير متصل'}")
+    logger.info("حالة MQTT: %s", 'متصل' if mqtt_connected else 'غير متصل')
+    logger.info("حالة InfluxDB: %s", 'متصل' if influx_connected else 'غير متصل')
     try:
+        # جدولة بـ deadline على monotonic clock: وقت التوليد لا يتراكم كـ drift
+        next_t = time.monotonic()
+        overruns = 0  # عدد العينات المتأخرة في فترة التأخر الحالية (log مرة لكل فترة وليس لكل عينة)
         while True:
             generate_sensor_data()
-            time.sleep(5)  # كل 5 ثوانٍ
+            next_t += SAMPLE_INTERVAL
+            now = time.monotonic()
+            delay = next_t - now
+            if delay < 0:
+                # overrun: العينة التالية فورًا حتى يلحق بالجدول
+                if overruns == 0:
+                    logger.warning("Simulator متأخر بـ %.3fs عن الجدول، خفف الحمل أو زد SAMPLE_INTERVAL", -delay)
+                overruns += 1
+                if -delay > MAX_LAG_TICKS * SAMPLE_INTERVAL:
+                    # متأخر جدًا: لا نرسل دفعة عينات متراكمة، نبدأ الجدول من الآن
+                    next_t = now
+            elif overruns:
+                logger.warning("Simulator عاد للجدول بعد %d عينة متأخرة", overruns)
+                overruns = 0
+            time.sleep(max(0, delay))
     except KeyboardInterrupt:
         logger.info("\nSimulator stopped by user.")
     finally:
+        stop_worker(_MQTT_Q, _mqtt_thread)
+        stop_worker(_INFLUX_Q, _influx_thread)
         if mqtt_client:
             mqtt_client.loop_stop()
             mqtt_client.disconnect()
@@ -148,4 +343,8 @@ if __name__ == "__main__":
             if write_api:
                 write_api.close()
             influx_client.close()
+        if _udp_sock:
+            _udp_sock.close()
+        if _publish_errors:
+            logger.warning("عدد مرات فشل MQTT publish: %d", _publish_errors)
         logger.info("تم إغلاق الاتصالات.")
\ No newline at end of file